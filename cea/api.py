@@ -29,8 +29,9 @@ def register_scripts():
                 if parameter.py_name in kwargs:
                     parameter.set(kwargs[parameter.py_name])
             cea_script.print_script_configuration(config)
-            if list(cea_script.missing_input_files(config)):
-                cea_script.print_missing_input_files(config)
+            missing_input_files = list(cea_script.missing_input_files(config))
+            if missing_input_files:
+                cea_script.print_missing_input_files(config, missing_input_files)
                 raise cea.MissingInputDataException()
             t0 = datetime.datetime.now()
             # run the script
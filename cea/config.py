@@ -514,13 +514,14 @@ class WeatherPathParameter(Parameter):
     def decode(self, value):
         if value == '':
             return ''
-        elif value in self.locator.get_weather_names():
+        weather_names = self.locator.get_weather_names()
+        if value in weather_names:
             weather_path = self.locator.get_weather(value)
         elif os.path.exists(value) and value.endswith('.epw'):
             weather_path = value
-        elif any(w.lower().startswith(value.lower()) for w in self.locator.get_weather_names()) and value.strip():
+        elif any(w.lower().startswith(value.lower()) for w in weather_names) and value.strip():
             # allow using shortcuts
-            weather_path = self.locator.get_weather([w for w in self.locator.get_weather_names() if w.lower().startswith(value.lower())][0])
+            weather_path = self.locator.get_weather([w for w in weather_names if w.lower().startswith(value.lower())][0])
         else:
             raise cea.ConfigError("Invalid weather path: {}".format(value))
         return weather_path
@@ -5,6 +5,7 @@ inputlocator.py - locate input files by name based on the reference folder struc
 
 
 
+import functools
 import os
 import cea.schemas
 import shutil
@@ -359,15 +360,16 @@ class InputLocator(object):
         of the pre-configured weather files (see ``get_weather_names``) or a path to an existing weather file.
         Returns the default weather file if no other file can be resolved.
         ..note: scripts should not use this, instead, use ``get_weather_file()`` - see the ``weather-helper`` script."""
-        default_weather_name = self.get_weather_names()[0]
+        weather_names = self.get_weather_names()
+        default_weather_name = weather_names[0]
         if not name:
             name = default_weather_name
         if os.path.exists(name) and name.endswith('.epw'):
             return name
 
-        if not name in self.get_weather_names():
+        if not name in weather_names:
             # allow using an abbreviation like "Zug" for "Zug-inducity_1990_2010_TMY"
-            for n in self.get_weather_names():
+            for n in weather_names:
                 if n.lower().startswith(name.lower()):
                     name = n
                     break
@@ -378,8 +380,7 @@ class InputLocator(object):
 
     def get_weather_names(self):
         """Return a list of all installed epw files in the system"""
-        weather_names = [os.path.splitext(f)[0] for f in os.listdir(self.weather_path)]
-        return weather_names
+        return list(list_weather_names(self.weather_path))
 
     def get_weather_folder(self):
         return self._ensure_folder(self.get_input_folder(), 'weather')
@@ -1018,6 +1019,12 @@ class InputLocator(object):
         return os.path.join(self.get_temporary_folder(), filename)
 
 
+@functools.lru_cache(maxsize=None)
+def list_weather_names(weather_path):
+    """The installed weather files don't change while the CEA is running, so the folder is only listed once"""
+    return tuple(os.path.splitext(f)[0] for f in os.listdir(weather_path))
+
+
 def check_cpg(shapefile_path):
     # ensures that the CPG file is the correct one
     if os.path.isfile(shapefile_path):
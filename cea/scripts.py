@@ -48,12 +48,18 @@ class CeaScript(object):
             print("- %(section_name)s:%(parameter_name)s = %(parameter_value)s" % locals())
             print("  (default: %s)" % parameter.default)
 
-    def print_missing_input_files(self, config):
+    def print_missing_input_files(self, config, missing_input_files=None):
+        """
+        :param missing_input_files: the result of ``missing_input_files(config)``, if already known (saves checking
+                                    the input files a second time)
+        """
+        if missing_input_files is None:
+            missing_input_files = self.missing_input_files(config)
         schema_data = schemas(config.plugins)
         print()
         print("---------------------------")
         print("ERROR: Missing input files:")
-        for method_name, path in self.missing_input_files(config):
+        for method_name, path in missing_input_files:
             script_suggestions = (schema_data[method_name]['created_by']
                                   if 'created_by' in schema_data[method_name]
                                   else None)
@@ -73,19 +79,24 @@ class CeaScript(object):
         locator = cea.inputlocator.InputLocator(config.scenario, config.plugins)
         config.restricted_to = restricted_to
 
+        lookup_cache = {}  # reading the zone geometry for the building names is expensive, only do it once
         for locator_spec in self.input_files:
             method_name, args = locator_spec[0], locator_spec[1:]
             method = getattr(locator, method_name)
-            path = method(*self._lookup_args(config, locator, args))
+            path = method(*self._lookup_args(config, locator, args, lookup_cache))
             if not os.path.exists(path):
                 yield [method_name, path]
 
-    def _lookup_args(self, config, locator, args):
+    def _lookup_args(self, config, locator, args, lookup_cache=None):
         """returns a list of arguments to a locator method"""
+        if lookup_cache is None:
+            lookup_cache = {}
         result = []
         for arg in args:
             if arg == 'building_name':
-                result.append(locator.get_zone_building_names()[0])
+                if arg not in lookup_cache:
+                    lookup_cache[arg] = locator.get_zone_building_names()[0]
+                result.append(lookup_cache[arg])
             else:
                 # expect an fqname for the config object
                 result.append(config.get(arg))
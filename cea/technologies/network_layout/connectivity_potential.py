@@ -7,9 +7,14 @@ a series of points (buildings) to the closest street
 
 
 import os
+from collections import Counter
 
+import fiona
+import numpy as np
 from geopandas import GeoDataFrame as gdf
-from shapely.geometry import Point, LineString, MultiPoint, box
+from geopandas import GeoSeries
+from scipy.spatial import cKDTree
+from shapely.geometry import Point, LineString, box, shape
 from shapely.ops import split, linemerge, snap
 
 import cea.config
@@ -27,11 +32,48 @@ __email__ = "cea@arch.ethz.ch"
 __status__ = "Production"
 
 
+def read_shapefile_columns(shapefile_path, columns):
+    """
+    Read the geometry and only the ``columns`` of a shapefile. The shapefile is opened once and the other fields of the
+    attribute table (.dbf) are dropped while reading the features, so they don't end up in the data frame.
+
+    :param str shapefile_path: path to the shapefile
+    :param List[str] columns: the fields to read, e.g. ``['Name']``
+    :rtype: geopandas.GeoDataFrame
+    """
+    with fiona.open(shapefile_path) as shapefile:
+        columns = [column for column in columns if column in shapefile.schema['properties']]
+        records = []
+        geometries = []
+        for feature in shapefile:
+            records.append([feature['properties'][column] for column in columns])
+            geometries.append(shape(feature['geometry']) if feature['geometry'] else None)
+        crs = shapefile.crs_wkt or None
+    return gdf(records, columns=columns, geometry=geometries, crs=crs)
+
+
+def build_spatial_index(geometries):
+    """Return a spatial index (R-tree) of ``geometries``. The index positions correspond to the order of
+    ``geometries``."""
+    return GeoSeries(list(geometries)).sindex
+
+
+def expand_bounds(bounds, distance):
+    """Grow a ``(minx, miny, maxx, maxy)`` bounding box by ``distance`` in all directions"""
+    minx, miny, maxx, maxy = bounds
+    return minx - distance, miny - distance, maxx + distance, maxy + distance
+
+
 def compute_intersections(lines, crs):
-    import itertools
+    lines = list(lines)
+    spatial_index = build_spatial_index(lines)
     inters = []
-    for line1, line2 in itertools.combinations(lines, 2):
-        if line1.intersects(line2):
+    for i, line1 in enumerate(lines):
+        # only pairs with overlapping bounding boxes can intersect
+        candidates = sorted(j for j in spatial_index.intersection(line1.bounds) if j > i)
+        for line2 in (lines[j] for j in candidates):
+            if not line1.intersects(line2):
+                continue
             inter = line1.intersection(line2)
             if "Point" == inter.type:
                 inters.append(inter)
@@ -74,32 +116,6 @@ def computer_end_points(lines, crs):
     return df
 
 
-def nearest_neighbor_within(others, point, max_distance):
-    """Find nearest point among others up to a maximum distance.
-
-    Args:
-        others: a list of Points or a MultiPoint
-        point: a Point
-        max_distance: maximum distance to search for the nearest neighbor
-
-    Returns:
-        A shapely Point if one is within max_distance, None otherwise
-    """
-    search_region = point.buffer(max_distance)
-    interesting_points = search_region.intersection(MultiPoint(others))
-
-    if not interesting_points:
-        closest_point = None
-    elif isinstance(interesting_points, Point):
-        closest_point = interesting_points
-    else:
-        distances = [point.distance(ip) for ip in interesting_points
-                     if point.distance(ip) > 0]
-        closest_point = interesting_points[distances.index(min(distances))]
-
-    return closest_point
-
-
 def find_isolated_endpoints(lines):
     """Find endpoints of lines that don't touch another line.
 
@@ -110,13 +126,14 @@ def find_isolated_endpoints(lines):
         A list of line end Points that don't touch any other line of lines
     """
 
+    lines = list(lines)
+    spatial_index = build_spatial_index(lines)
     isolated_endpoints = []
     for i, line in enumerate(lines):
-        other_lines = lines[:i] + lines[i + 1:]
         for q in [0, -1]:
             endpoint = Point(line.coords[q])
-            if any(endpoint.touches(another_line)
-                   for another_line in other_lines):
+            if any(endpoint.touches(lines[j])
+                   for j in spatial_index.intersection(endpoint.bounds) if j != i):
                 continue
             else:
                 isolated_endpoints.append(endpoint)
@@ -179,28 +196,40 @@ def snappy_endings(lines, max_distance, crs):
     # isolated endpoints are going to snap to the closest vertex
     isolated_endpoints = find_isolated_endpoints(snapped_lines)
 
+    # find all vertices within a radius of max_distance of each isolated endpoint in a single query
+    snapping_coordinates = np.array([point.coords[0] for point in snapping_points])
+    endpoint_coordinates = np.array([endpoint.coords[0] for endpoint in isolated_endpoints])
+    if isolated_endpoints:
+        candidates_per_endpoint = cKDTree(snapping_coordinates).query_ball_point(endpoint_coordinates, max_distance)
+    else:
+        candidates_per_endpoint = []
+    # number of vertices at each location, snapping moves a vertex to the location of another one
+    vertex_count = Counter(map(tuple, snapping_coordinates))
+
     # only move isolated endpoints, one by one
-    for endpoint in isolated_endpoints:
-        # find all vertices within a radius of max_distance as possible
-        target = nearest_neighbor_within(snapping_points, endpoint,
-                                         max_distance)
+    for endpoint, coordinates, candidates in zip(isolated_endpoints, endpoint_coordinates, candidates_per_endpoint):
+        # the closest vertex (that is not the endpoint itself)
+        candidates = np.array([c for c in candidates if vertex_count[tuple(snapping_coordinates[c])] > 0], dtype=int)
+        distances = np.hypot(*(snapping_coordinates[candidates] - coordinates).T)
+        candidates, distances = candidates[distances > 0], distances[distances > 0]
 
         # do nothing if no target point to snap to is found
-        if not target:
+        if not len(candidates):
             continue
+        target_coordinates = tuple(snapping_coordinates[candidates[np.argmin(distances)]])
+        target = Point(target_coordinates)
 
-            # find the LineString to modify within snapped_lines and update it
+        # find the LineString to modify within snapped_lines and update it
         for i, snapped_line in enumerate(snapped_lines):
             if endpoint.touches(snapped_line):
                 snapped_lines[i] = bend_towards(snapped_line, where=endpoint,
                                                 to=target)
                 break
 
-        # also update the corresponding snapping_points
-        for i, snapping_point in enumerate(snapping_points):
-            if endpoint.equals(snapping_point):
-                snapping_points[i] = target
-                break
+        # also update the vertex count (the vertex is now a duplicate of the target)
+        if vertex_count[tuple(coordinates)] > 0:
+            vertex_count[tuple(coordinates)] -= 1
+            vertex_count[target_coordinates] += 1
 
     # post-processing: remove any resulting lines of length 0
     snapped_lines = [s for s in snapped_lines if s.length > 0]
@@ -242,39 +271,16 @@ def split_line_by_nearest_points(gdf_line, gdf_points, tolerance_grid_snap, crs)
     return gdf_segments
 
 
-def nearest_neighbor_within(others, point, max_distance):
-    """Find nearest point among others up to a maximum distance.
-
-    Args:
-        others: a list of Points or a MultiPoint
-        point: a Point
-        max_distance: maximum distance to search for the nearest neighbor
-
-    Returns:
-        A shapely Point if one is within max_distance, None otherwise
-    """
-    search_region = point.buffer(max_distance)
-    interesting_points = search_region.intersection(MultiPoint(others))
-
-    if not interesting_points:
-        closest_point = None
-    elif isinstance(interesting_points, Point):
-        closest_point = interesting_points
-    else:
-        distances = [point.distance(ip) for ip in interesting_points
-                     if point.distance(ip) > 0]
-        closest_point = interesting_points[distances.index(min(distances))]
-
-    return closest_point
-
-
 def near_analysis(buiding_centroids, street_network, crs):
     near_point = []
     building_name = []
+    lines = list(street_network.geometry)
+    spatial_index = build_spatial_index(lines)
     for point, name in zip(buiding_centroids.geometry, buiding_centroids.Name):
         point._crs = crs
         distance = 10e10
-        for line in street_network.geometry:
+        for i in nearest_line_candidates(point, lines, spatial_index):
+            line = lines[i]
             line._crs = crs
             nearest_point_candidate = line.interpolate(line.project(point))
             distance_candidate = point.distance(nearest_point_candidate)
@@ -290,10 +296,35 @@ def near_analysis(buiding_centroids, street_network, crs):
     return df
 
 
+def nearest_line_candidates(point, lines, spatial_index):
+    """
+    Return the (sorted) positions of the lines that may be the closest to ``point``. The search window is grown until
+    it contains at least one line, then widened to the distance of the closest line found so far: any line closer than
+    that must have a bounding box within that distance.
+    """
+    search_distance = 1.0
+    candidates = list(spatial_index.intersection(expand_bounds(point.bounds, search_distance)))
+    while not candidates and search_distance < 10e10:
+        search_distance *= 10
+        candidates = list(spatial_index.intersection(expand_bounds(point.bounds, search_distance)))
+    if not candidates:
+        return []
+    distance = min(point.distance(lines[i]) for i in candidates)
+    return sorted(spatial_index.intersection(expand_bounds(point.bounds, distance)))
+
+
 def snap_points(points, lines, tolerance, crs):
     length = lines.shape[0]
+    point_geometries = list(points.geometry)
+    spatial_index = build_spatial_index(point_geometries)
     for i in range(length):
-        for point in points.geometry:
+        # only points close to the line can be snapped
+        candidates = sorted(spatial_index.intersection(expand_bounds(lines.loc[i, "geometry"].bounds, tolerance)))
+        position = 0
+        while position < len(candidates):
+            j = candidates[position]
+            position += 1
+            point = point_geometries[j]
             line = lines.loc[i, "geometry"]
             line._crs = crs
             point._crs = crs
@@ -316,6 +347,10 @@ def snap_points(points, lines, tolerance, crs):
                     ### Stitch together the first segment, the interpolated point, and the last segment
                     new_line = linemerge((LineString(line_1_points), LineString(line_2_points)))
                     lines.loc[i, "geometry"] = new_line
+                    # the new line can reach further than the old one, so look again for the (later) points close to it
+                    reachable = spatial_index.intersection(expand_bounds(new_line.bounds, tolerance))
+                    candidates = candidates[:position] + sorted(
+                        set(candidates[position:]).union(k for k in reachable if k > j))
 
     G = points["geometry"].apply(lambda geom: geom.wkb)
     points = points.loc[G.drop_duplicates().index]
@@ -406,8 +441,8 @@ def calc_connectivity_network(path_streets_shp, building_centroids_df, temp_path
     :param path_potential_network: output path shapefile
     :return:
     """
-    # first get the street network
-    street_network = gdf.from_file(path_streets_shp)
+    # first get the street network (only the geometry is needed)
+    street_network = read_shapefile_columns(path_streets_shp, [])
 
     # check coordinate system
     street_network = street_network.to_crs(get_geographic_coordinate_system())
@@ -1,13 +1,16 @@
 
 
 
+import glob
+import hashlib
 import os
+import pickle
+import shutil
 
+import cea
 import cea.config
 import cea.inputlocator
-from cea.technologies.network_layout.connectivity_potential import calc_connectivity_network
-from cea.technologies.network_layout.steiner_spanning_tree import calc_steiner_spanning_tree
-from cea.technologies.network_layout.substations_location import calc_building_centroids
+from cea.constants import SHAPEFILE_TOLERANCE, SNAP_TOLERANCE
 
 __author__ = "Jimeno A. Fonseca"
 __copyright__ = "Copyright 2017, Architecture and Building Systems - ETH Zurich"
@@ -18,8 +21,17 @@ __maintainer__ = "Daren Thomas"
 __email__ = "cea@arch.ethz.ch"
 __status__ = "Production"
 
+# bump this when the calculation of the building centroids or the potential network changes (connectivity_potential,
+# substations_location and the functions they use), so that the potential networks cached by older code are ignored
+POTENTIAL_NETWORK_CACHE_VERSION = 2
+
+# number of potential networks (e.g. of different scenarios) kept in the temporary folder
+POTENTIAL_NETWORK_CACHE_SIZE = 10
+
 
 def layout_network(network_layout, locator, plant_building_names=None, output_name_network="", optimization_flag=False):
+    # imported here, so that importing this module (e.g. for ``NetworkLayout``) doesn't load the geometry libraries
+    from cea.technologies.network_layout.steiner_spanning_tree import calc_steiner_spanning_tree
 
     # Local variables
     if plant_building_names is None:
@@ -34,24 +46,10 @@ def layout_network(network_layout, locator, plant_building_names=None, output_na
     type_network = network_layout.network_type
     create_plant = True #always create a plant or there will be errors in the thermal network simulation...
     list_district_scale_buildings = network_layout.connected_buildings
-    consider_only_buildings_with_demand = network_layout.consider_only_buildings_with_demand
     allow_looped_networks = network_layout.allow_looped_networks
 
-    path_streets_shp = locator.get_street_network()  # shapefile with the stations
-    path_zone_shp = locator.get_zone_geometry()
-
-    # Calculate points where the substations will be located (building centroids)
-    building_centroids_df = calc_building_centroids(path_zone_shp,
-                                                    temp_path_building_centroids_shp,
-                                                    list_district_scale_buildings,
-                                                    consider_only_buildings_with_demand,
-                                                    type_network,
-                                                    total_demand_location)
-
-    # Calculate potential network
-    crs_projected = calc_connectivity_network(path_streets_shp,
-                                              building_centroids_df,
-                                              temp_path_potential_network_shp)
+    crs_projected = calc_potential_network(network_layout, locator, temp_path_building_centroids_shp,
+                                           temp_path_potential_network_shp)
 
     # calc minimum spanning tree and save results to disk
     path_output_edges_shp = locator.get_network_layout_edges_shapefile(type_network, output_name_network)
@@ -75,7 +73,118 @@ def layout_network(network_layout, locator, plant_building_names=None, output_na
                                allow_looped_networks,
                                optimization_flag,
                                plant_building_names,
-                               disconnected_building_names)
+                               disconnected_building_names,
+                               network_layout.steiner_tree_method)
+
+
+def calc_potential_network(network_layout, locator, temp_path_building_centroids_shp, temp_path_potential_network_shp):
+    """
+    Calculate the building centroids (substations) and the potential network connecting them to the streets.
+
+    The results only depend on the geometry inputs, so they are cached in the temporary folder: the optimization of
+    the network layout calls ``layout_network`` many times with the same inputs. Only the
+    ``POTENTIAL_NETWORK_CACHE_SIZE`` most recently used entries are kept.
+
+    :param NetworkLayout network_layout: network layout parameters
+    :param cea.inputlocator.InputLocator locator: the locator of the scenario
+    :param str temp_path_building_centroids_shp: e.g. "%TEMP%/nodes_buildings.shp"
+    :param str temp_path_potential_network_shp: e.g. "%TEMP%/potential_network.shp"
+    :return: the projected coordinate system of the potential network
+    """
+    from cea.technologies.network_layout.connectivity_potential import calc_connectivity_network
+    from cea.technologies.network_layout.substations_location import calc_building_centroids
+
+    type_network = network_layout.network_type
+    list_district_scale_buildings = network_layout.connected_buildings
+    consider_only_buildings_with_demand = network_layout.consider_only_buildings_with_demand
+    total_demand_location = locator.get_total_demand()
+    path_streets_shp = locator.get_street_network()  # shapefile with the stations
+    path_zone_shp = locator.get_zone_geometry()
+
+    cache_key = calc_potential_network_cache_key(path_zone_shp, path_streets_shp, list_district_scale_buildings,
+                                                 consider_only_buildings_with_demand, type_network,
+                                                 total_demand_location)
+    cache_folder = locator.get_temporary_file("netcache_{key}".format(key=cache_key))
+    if os.path.exists(cache_folder):
+        os.utime(cache_folder)  # mark as recently used
+        copy_shapefile(os.path.join(cache_folder, "nodes_buildings.shp"), temp_path_building_centroids_shp)
+        copy_shapefile(os.path.join(cache_folder, "potential_network.shp"), temp_path_potential_network_shp)
+        with open(os.path.join(cache_folder, "crs.pickle"), "rb") as f:
+            crs_projected = pickle.load(f)
+    else:
+        # Calculate points where the substations will be located (building centroids)
+        building_centroids_df = calc_building_centroids(path_zone_shp,
+                                                        temp_path_building_centroids_shp,
+                                                        list_district_scale_buildings,
+                                                        consider_only_buildings_with_demand,
+                                                        type_network,
+                                                        total_demand_location)
+
+        # Calculate potential network
+        crs_projected = calc_connectivity_network(path_streets_shp,
+                                                  building_centroids_df,
+                                                  temp_path_potential_network_shp)
+
+        # populate the cache - copy to a staging folder first so a half-written cache is never used
+        staging_folder = cache_folder + ".{pid}".format(pid=os.getpid())
+        os.makedirs(staging_folder, exist_ok=True)
+        copy_shapefile(temp_path_building_centroids_shp, os.path.join(staging_folder, "nodes_buildings.shp"))
+        copy_shapefile(temp_path_potential_network_shp, os.path.join(staging_folder, "potential_network.shp"))
+        with open(os.path.join(staging_folder, "crs.pickle"), "wb") as f:
+            pickle.dump(crs_projected, f)
+        try:
+            os.rename(staging_folder, cache_folder)
+        except OSError:
+            # another process populated the cache in the meantime
+            shutil.rmtree(staging_folder, ignore_errors=True)
+
+        # remove the least recently used entries (but not the staging folders of other processes)
+        entries = [path for path in glob.glob(locator.get_temporary_file("netcache_*"))
+                   if "." not in os.path.basename(path)]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry in entries[POTENTIAL_NETWORK_CACHE_SIZE:]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+    return crs_projected
+
+
+def calc_potential_network_cache_key(path_zone_shp, path_streets_shp, list_district_scale_buildings,
+                                     consider_only_buildings_with_demand, type_network, total_demand_location):
+    """
+    Return a hash of all the inputs used to calculate the building centroids and the potential network, including the
+    CEA version and ``POTENTIAL_NETWORK_CACHE_VERSION``.
+
+    :param str path_zone_shp: "{general:scenario}/inputs/building-geometry/zone.shp"
+    :param str path_streets_shp: "{general:scenario}/inputs/networks/streets.shp"
+    :param List[str] list_district_scale_buildings: e.g. ``['B001', 'B002']``
+    :param bool consider_only_buildings_with_demand:
+    :param str type_network: "DC" or "DH"
+    :param str total_demand_location: "{general:scenario}/outputs/data/demand/Total_demand.csv"
+    :rtype: str
+    """
+    key = hashlib.blake2b()
+    key.update(repr((cea.__version__, POTENTIAL_NETWORK_CACHE_VERSION)).encode("utf-8"))
+    for path_shp in (path_zone_shp, path_streets_shp):
+        for extension in (".shp", ".dbf", ".prj"):
+            path = os.path.splitext(path_shp)[0] + extension
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    key.update(f.read())
+    key.update(repr(sorted(list_district_scale_buildings)).encode("utf-8"))
+    key.update(repr((SHAPEFILE_TOLERANCE, SNAP_TOLERANCE)).encode("utf-8"))
+    if consider_only_buildings_with_demand:
+        key.update(type_network.encode("utf-8"))
+        with open(total_demand_location, "rb") as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+
+def copy_shapefile(source_shp, destination_shp):
+    """Copy a shapefile including all its sidecar files (.shx, .dbf, .prj, .cpg...)"""
+    source_base = os.path.splitext(source_shp)[0]
+    destination_base = os.path.splitext(destination_shp)[0]
+    for source in glob.glob(source_base + ".*"):
+        shutil.copy2(source, destination_base + os.path.splitext(source)[1])
 
 
 class NetworkLayout(object):
@@ -90,9 +199,11 @@ class NetworkLayout(object):
         self.create_plant = True
         self.allow_looped_networks = False
         self.consider_only_buildings_with_demand = False
+        self.steiner_tree_method = "mehlhorn"
 
         attributes = ["network_type", "pipe_diameter", "type_mat", "create_plant", "allow_looped_networks",
-                      "consider_only_buildings_with_demand", "connected_buildings", "disconnected_buildings"]
+                      "consider_only_buildings_with_demand", "connected_buildings", "disconnected_buildings",
+                      "steiner_tree_method"]
         for attr in attributes:
             # copy any matching attributes in network_layout (because it could be an instance of NetworkInfo)
             if hasattr(network_layout, attr):
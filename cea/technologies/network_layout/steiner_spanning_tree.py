@@ -5,13 +5,16 @@ This script calculates the minimum spanning tree of a shapefile network
 
 
 
-import math
+import hashlib
+import heapq
 import os
+from collections import OrderedDict
 
 import networkx as nx
+import numpy as np
 import pandas as pd
 from geopandas import GeoDataFrame as gdf
-from networkx.algorithms.approximation.steinertree import steiner_tree
+from numba import jit
 from shapely.geometry import LineString
 from typing import List
 
@@ -28,6 +31,16 @@ __maintainer__ = "Daren Thomas"
 __email__ = "cea@arch.ethz.ch"
 __status__ = "Production"
 
+# the exact steiner tree is only calculated for up to this many terminals (the runtime grows exponentially)
+MAX_EXACT_STEINER_TERMINALS = 10
+
+# the steiner solver compares edge lengths as integer millimeters, distances of unreachable nodes are UNREACHABLE
+LENGTH_PER_METER = 1000
+UNREACHABLE = np.iinfo(np.int64).max
+
+# the SteinerSolver of the potential network read last, keyed by the content of the shapefile and the weight field
+_steiner_solver_cache = {}
+
 
 def calc_steiner_spanning_tree(crs_projected,
                                temp_path_potential_network_shp,
@@ -44,7 +57,8 @@ def calc_steiner_spanning_tree(crs_projected,
                                allow_looped_networks,
                                optimization_flag,
                                plant_building_names,
-                               disconnected_building_names):
+                               disconnected_building_names,
+                               method='mehlhorn'):
     """
     Calculate the minimum spanning tree of the network. Note that this function can't be run in parallel in it's
     present form.
@@ -65,20 +79,14 @@ def calc_steiner_spanning_tree(crs_projected,
     :param bool optimization_flag:
     :param List[str] plant_building_names: e.g. ``['B001']``
     :param List[str] disconnected_building_names: e.g. ``['B002', 'B010', 'B004', 'B005', 'B009']``
+    :param str method: algorithm used to calculate the steiner tree, either "mehlhorn" (default), "kou" or "exact"
     :return: ``(mst_edges, mst_nodes)``
     """
-    # read shapefile into networkx format into a directed potential_network_graph, this is the potential network
-    potential_network_graph = nx.read_shp(temp_path_potential_network_shp)
+    # the undirected potential network graph (and its shortest paths) are re-used while the shapefile doesn't change
+    steiner_solver = get_steiner_solver(temp_path_potential_network_shp, weight_field)
+    G = steiner_solver.G
     building_nodes_graph = nx.read_shp(temp_path_building_centroids_shp)
 
-    # transform to an undirected potential_network_graph
-    iterator_edges = potential_network_graph.edges(data=True)
-    G = nx.Graph()
-    for (x, y, data) in iterator_edges:
-        x = (round(x[0], SHAPEFILE_TOLERANCE), round(x[1], SHAPEFILE_TOLERANCE))
-        y = (round(y[0], SHAPEFILE_TOLERANCE), round(y[1], SHAPEFILE_TOLERANCE))
-        G.add_edge(x, y, weight=data[weight_field])
-
     # get the building nodes and coordinates
     iterator_nodes = building_nodes_graph.nodes(data=True)
     terminal_nodes_coordinates = []
@@ -94,7 +102,7 @@ def calc_steiner_spanning_tree(crs_projected,
 
     # calculate steiner spanning tree of undirected potential_network_graph
     try:
-        mst_non_directed = nx.Graph(steiner_tree(G, terminal_nodes_coordinates))
+        mst_non_directed = steiner_solver.solve(terminal_nodes_coordinates, method)
         nx.write_shp(mst_non_directed, output_network_folder)  # need to write to disk and then import again
         mst_nodes = gdf.from_file(path_output_nodes_shp)
         mst_edges = gdf.from_file(path_output_edges_shp)
@@ -160,6 +168,366 @@ def calc_steiner_spanning_tree(crs_projected,
     mst_nodes[['geometry', 'Building', 'Name', 'Type']].to_file(path_output_nodes_shp, driver='ESRI Shapefile')
 
 
+def get_steiner_solver(path_potential_network_shp, weight_field):
+    """
+    Return a ``SteinerSolver`` for the potential network shapefile. The solver is re-used as long as the shapefile
+    doesn't change, so that the network optimization (which creates many layouts of the same potential network) only
+    reads the graph and calculates its shortest paths once. The solver is identified by the content of the shapefile,
+    not its path, because the potential network is copied from the cache for each layout (see
+    ``calc_potential_network``).
+
+    :param str path_potential_network_shp: e.g. "TEMP/potential_network.shp"
+    :param str weight_field: e.g. "Shape_Leng"
+    :rtype: SteinerSolver
+    """
+    key = hashlib.blake2b(weight_field.encode("utf-8"))
+    for extension in (".shp", ".dbf"):
+        with open(os.path.splitext(path_potential_network_shp)[0] + extension, "rb") as f:
+            key.update(f.read())
+    key = key.hexdigest()
+    if key not in _steiner_solver_cache:
+        # read the shapefile once into arrays of edges between the (rounded) end points of the lines
+        potential_network = gdf.from_file(path_potential_network_shp)
+        node_index = OrderedDict()
+        edges = OrderedDict()  # (u, v) -> length, the undirected edges of the potential network
+        for line, length in zip(potential_network.geometry, potential_network[weight_field]):
+            u, v = [node_index.setdefault((round(x, SHAPEFILE_TOLERANCE), round(y, SHAPEFILE_TOLERANCE)),
+                                          len(node_index))
+                    for x, y in (line.coords[0], line.coords[-1])]
+            edges[(min(u, v), max(u, v))] = length
+        source, target = np.array(list(edges.keys()), dtype=np.int32).reshape(-1, 2).T
+        length = np.array(list(edges.values()), dtype=np.float64)
+
+        # undirected potential network graph, only used to build the output from the edges of the steiner tree
+        nodes = list(node_index.keys())
+        G = nx.Graph()
+        G.add_nodes_from(nodes)
+        G.add_weighted_edges_from((nodes[u], nodes[v], w) for (u, v), w in edges.items())
+
+        _steiner_solver_cache.clear()  # only keep the solver of the current potential network
+        _steiner_solver_cache[key] = SteinerSolver(G, (source, target, length))
+    return _steiner_solver_cache[key]
+
+
+class SteinerSolver(object):
+    """
+    Calculates steiner trees of a fixed (potential network) graph for changing sets of terminal nodes. The single
+    source shortest paths of the terminals are kept in a least-recently-used cache, so that terminals that show up
+    again (e.g. during the network optimization) don't need another dijkstra run.
+    """
+
+    def __init__(self, G, edges, weight='weight', cache_size=512):
+        """
+        :param nx.Graph G: undirected potential network graph
+        :param edges: ``(source, target, length)`` arrays of the edges of ``G`` with the nodes numbered in the order
+                      of ``G.nodes()`` and the lengths in meters
+        :param str weight: name of the edge attribute holding the edge length
+        :param int cache_size: maximum number of single source shortest paths to keep in memory
+        """
+        self.G = G
+        self.weight = weight
+        self.cache_size = cache_size
+        self.nodes = list(G.nodes())
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+
+        # the algorithms only touch these arrays (structure of arrays), not the networkx graph
+        # only the order of the lengths matters, so they are rounded to millimeters (int32 is enough for 2000 km)
+        source, target, length = edges
+        self.edge_source, self.edge_target = source, target
+        self.edge_length = np.round(np.asarray(length, dtype=np.float64) * LENGTH_PER_METER).astype(np.int32)
+        self.indptr, self.indices, self.weights = edge_arrays_to_csr(len(self.nodes), source, target,
+                                                                     self.edge_length)
+        self._shortest_paths = OrderedDict()  # node -> (distance, predecessor)
+
+    def solve(self, terminal_nodes, method='mehlhorn'):
+        """
+        Calculate the steiner tree spanning ``terminal_nodes``.
+
+        :param List[tuple] terminal_nodes: nodes of the graph that need to be connected (building coordinates)
+        :param str method: either "mehlhorn", "kou" or "exact" (falls back to "mehlhorn" for more than
+                           ``MAX_EXACT_STEINER_TERMINALS`` terminals)
+        :rtype: nx.Graph
+        """
+        if method == 'exact' and len(set(terminal_nodes)) > MAX_EXACT_STEINER_TERMINALS:
+            print("Too many terminals ({n}) to calculate the exact steiner tree, using mehlhorn's algorithm "
+                  "instead".format(n=len(set(terminal_nodes))))
+            method = 'mehlhorn'
+
+        if method == 'mehlhorn':
+            return self.mehlhorn_steiner_tree(terminal_nodes)
+        elif method == 'kou':
+            return self.kou_steiner_tree(terminal_nodes)
+        elif method == 'exact':
+            return self.exact_steiner_tree(terminal_nodes)
+        else:
+            raise ValueError("Invalid value for variable 'method': {method}".format(method=method))
+
+    def shortest_paths(self, source):
+        """
+        Return the single source shortest paths from ``source`` as two arrays indexed like ``self.nodes``: the
+        distance to each node in millimeters (``UNREACHABLE`` if unreachable) and the index of its predecessor (-1 for
+        the source and unreachable nodes).
+
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        if source in self._shortest_paths:
+            self._shortest_paths.move_to_end(source)
+            return self._shortest_paths[source]
+
+        sources = np.array([self.node_index[source]], dtype=np.int64)
+        distance, predecessor, _ = dijkstra_csr(self.indptr, self.indices, self.weights, sources)
+
+        self._shortest_paths[source] = (distance, predecessor)
+        if len(self._shortest_paths) > self.cache_size:
+            self._shortest_paths.popitem(last=False)
+        return distance, predecessor
+
+    def kou_steiner_tree(self, terminal_nodes):
+        """
+        Approximate the steiner tree with the algorithm of Kou et al: the minimum spanning tree of the metric closure
+        of the terminals, expanded back to the shortest paths in the graph.
+
+        :param List[tuple] terminal_nodes: nodes of the graph that need to be connected (building coordinates)
+        :rtype: nx.Graph
+        """
+        terminal_nodes = list(OrderedDict.fromkeys(terminal_nodes))  # remove duplicates, keep the order
+
+        # metric closure of the terminals
+        metric_closure = nx.Graph()
+        metric_closure.add_nodes_from(terminal_nodes)
+        for i, u in enumerate(terminal_nodes):
+            distance, _ = self.shortest_paths(u)
+            for v in terminal_nodes[i + 1:]:
+                if distance[self.node_index[v]] == UNREACHABLE:
+                    raise ValueError('The terminal nodes are not connected in the potential network.')
+                metric_closure.add_edge(u, v, weight=distance[self.node_index[v]])
+
+        # expand the minimum spanning tree of the metric closure to the shortest paths in the graph
+        steiner_edges = set()
+        for u, v in nx.minimum_spanning_edges(metric_closure, weight='weight', data=False):
+            _, predecessor = self.shortest_paths(u)
+            source, node = self.node_index[u], self.node_index[v]
+            while node != source:
+                steiner_edges.add((self.nodes[predecessor[node]], self.nodes[node]))
+                node = predecessor[node]
+
+        return spanning_tree_of_steiner_edges(self.G, steiner_edges, terminal_nodes, self.weight)
+
+    def mehlhorn_steiner_tree(self, terminal_nodes):
+        """
+        Approximate the steiner tree with Mehlhorn's algorithm. Instead of building the metric closure over all
+        terminals (Kou et al.), a single multi-source dijkstra is used to assign each node to its nearest terminal.
+        The total runtime is O(|E| + |V|log|V|) and the result is a 2-approximation.
+
+        :param List[tuple] terminal_nodes: nodes of the graph that need to be connected (building coordinates)
+        :rtype: nx.Graph
+        """
+        terminal_nodes = list(OrderedDict.fromkeys(terminal_nodes))  # remove duplicates, keep the order
+        if len(terminal_nodes) < 2:
+            steiner = nx.Graph()
+            steiner.add_nodes_from(terminal_nodes)
+            return steiner
+
+        # (1) multi-source dijkstra: distance to (and predecessor towards) the nearest terminal of each node
+        sources = np.array([self.node_index[t] for t in terminal_nodes], dtype=np.int64)
+        distance, predecessor, nearest_terminal = dijkstra_csr(self.indptr, self.indices, self.weights, sources)
+
+        # (2) complete graph of terminals: keep the shortest bridge (u, v) for each pair of neighbouring voronoi cells
+        u, v = self.edge_source, self.edge_target
+        terminal_u, terminal_v = nearest_terminal[u], nearest_terminal[v]
+        bridges = np.flatnonzero((terminal_u != terminal_v) & (terminal_u >= 0) & (terminal_v >= 0))
+        bridge_length = distance[u[bridges]] + self.edge_length[bridges] + distance[v[bridges]]
+        bridges, bridge_length = bridges[np.argsort(bridge_length, kind='stable')], np.sort(bridge_length)
+        terminal_pair = (np.minimum(terminal_u[bridges], terminal_v[bridges]) * len(terminal_nodes)
+                         + np.maximum(terminal_u[bridges], terminal_v[bridges]))
+        _, shortest = np.unique(terminal_pair, return_index=True)
+
+        terminal_graph = nx.Graph()
+        terminal_graph.add_nodes_from(range(len(terminal_nodes)))
+        for i in shortest:
+            bridge = bridges[i]
+            terminal_graph.add_edge(terminal_u[bridge], terminal_v[bridge], weight=bridge_length[i],
+                                    bridge=(u[bridge], v[bridge]))
+
+        # (3) minimum spanning tree of the terminal graph
+        # (4) expand each edge of the spanning tree back to its path in G
+        steiner_edges = set()
+        for _, _, data in nx.minimum_spanning_edges(terminal_graph, weight='weight', data=True):
+            u, v = data['bridge']
+            steiner_edges.add((self.nodes[u], self.nodes[v]))
+            for node in (u, v):
+                while predecessor[node] >= 0:
+                    steiner_edges.add((self.nodes[predecessor[node]], self.nodes[node]))
+                    node = predecessor[node]
+
+        # (5) minimum spanning tree of the expanded subgraph, then prune non-terminal leaves
+        return spanning_tree_of_steiner_edges(self.G, steiner_edges, terminal_nodes, self.weight)
+
+    def exact_steiner_tree(self, terminal_nodes):
+        """
+        Calculate the optimal steiner tree with the Dijkstra-Steiner algorithm (Hougardy, Silvanus and Vygen, 2017).
+        This is the dynamic program of Dreyfus and Wagner, with the labels ``(node, subset of terminals)`` made
+        permanent in the order of a dijkstra search. The search is guided by a lower bound of the cost to connect the
+        rest of the terminals (the distance to the farthest of them), so most labels are never made permanent.
+
+        The runtime grows exponentially with the number of terminals, see ``MAX_EXACT_STEINER_TERMINALS``.
+
+        :param List[tuple] terminal_nodes: nodes of the graph that need to be connected (building coordinates)
+        :rtype: nx.Graph
+        """
+        terminal_nodes = list(OrderedDict.fromkeys(terminal_nodes))  # remove duplicates, keep the order
+        if len(terminal_nodes) < 2:
+            steiner = nx.Graph()
+            steiner.add_nodes_from(terminal_nodes)
+            return steiner
+
+        # the last terminal is the root, the subsets (bitmasks) are subsets of the other terminals
+        terminal_indexes = [self.node_index[t] for t in terminal_nodes]
+        root = terminal_indexes[-1]
+        all_terminals = (1 << (len(terminal_indexes) - 1)) - 1
+        terminal_distances = np.array([self.shortest_paths(t)[0] for t in terminal_nodes])
+        indptr, indices, weights = self.indptr.tolist(), self.indices.tolist(), self.weights.tolist()
+
+        future_costs = {}  # subset -> lower bound for connecting each node to the root and the terminals not in subset
+
+        def future_cost(node, subset):
+            if subset not in future_costs:
+                missing = [i for i in range(len(terminal_indexes) - 1) if not subset & (1 << i)]
+                future_costs[subset] = terminal_distances[missing + [len(terminal_indexes) - 1]].max(axis=0).tolist()
+            return future_costs[subset][node]
+
+        label = {}  # (node, subset) -> length of the shortest tree connecting node and the terminals in subset
+        back = {}  # (node, subset) -> how the label was reached, to build the tree
+        permanent = set()
+        permanent_subsets = {}  # node -> subsets with a permanent label at node
+        heap = []
+        for i, t in enumerate(terminal_indexes[:-1]):
+            label[(t, 1 << i)] = 0.0
+            back[(t, 1 << i)] = None
+            heapq.heappush(heap, (future_cost(t, 1 << i), t, 1 << i))
+
+        def update(node, subset, length, how):
+            key = (node, subset)
+            if key not in permanent and length < label.get(key, np.inf):
+                label[key] = length
+                back[key] = how
+                heapq.heappush(heap, (length + future_cost(node, subset), node, subset))
+
+        while heap:
+            _, node, subset = heapq.heappop(heap)
+            if (node, subset) in permanent:
+                continue  # outdated heap entry
+            permanent.add((node, subset))
+            if node == root and subset == all_terminals:
+                break
+            node_label = label[(node, subset)]
+
+            # grow the tree along an edge
+            for j in range(indptr[node], indptr[node + 1]):
+                update(indices[j], subset, node_label + weights[j], ('edge', node))
+
+            # merge with the trees at this node that span other terminals
+            for other_subset in permanent_subsets.get(node, []):
+                if not subset & other_subset:
+                    update(node, subset | other_subset, node_label + label[(node, other_subset)],
+                           ('merge', subset, other_subset))
+            permanent_subsets.setdefault(node, []).append(subset)
+
+        if (root, all_terminals) not in permanent:
+            raise ValueError('The terminal nodes are not connected in the potential network.')
+
+        # follow the back pointers to collect the edges of the tree
+        steiner_edges = set()
+        stack = [(root, all_terminals)]
+        while stack:
+            node, subset = stack.pop()
+            how = back[(node, subset)]
+            if how is None:
+                continue
+            elif how[0] == 'edge':
+                steiner_edges.add((self.nodes[how[1]], self.nodes[node]))
+                stack.append((how[1], subset))
+            else:
+                stack.append((node, how[1]))
+                stack.append((node, how[2]))
+
+        return spanning_tree_of_steiner_edges(self.G, steiner_edges, terminal_nodes, self.weight)
+
+
+def spanning_tree_of_steiner_edges(G, steiner_edges, terminal_nodes, weight='weight'):
+    """
+    Return the minimum spanning tree of the subgraph of ``G`` made up of ``steiner_edges`` with all the leaves that
+    are not terminal nodes removed (the last steps of both Kou's and Mehlhorn's algorithm).
+    """
+    terminal_nodes = set(terminal_nodes)
+    steiner = nx.Graph(nx.minimum_spanning_tree(G.edge_subgraph(steiner_edges), weight=weight))
+    leaves = [n for n in steiner.nodes() if steiner.degree(n) == 1 and n not in terminal_nodes]
+    while leaves:
+        steiner.remove_nodes_from(leaves)
+        leaves = [n for n in steiner.nodes() if steiner.degree(n) == 1 and n not in terminal_nodes]
+
+    if len(terminal_nodes) > 1 and (not terminal_nodes.issubset(steiner.nodes()) or not nx.is_connected(steiner)):
+        raise ValueError('The terminal nodes are not connected in the potential network.')
+    return steiner
+
+
+def edge_arrays_to_csr(number_of_nodes, source, target, length):
+    """
+    Convert the undirected edges ``(source, target, length)`` to compressed sparse row arrays (both directions of
+    each edge), as used by ``dijkstra_csr``: the neighbours of node ``i`` are ``indices[indptr[i]:indptr[i + 1]]`` and
+    the edge lengths ``weights[indptr[i]:indptr[i + 1]]``.
+
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    """
+    both_source = np.concatenate([source, target])
+    both_target = np.concatenate([target, source])
+    both_length = np.concatenate([length, length])
+
+    order = np.argsort(both_source, kind='stable')
+    indptr = np.zeros(number_of_nodes + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(np.bincount(both_source, minlength=number_of_nodes))
+    return indptr, both_target[order], both_length[order]
+
+
+@jit(nopython=True, cache=True)
+def dijkstra_csr(indptr, indices, weights, sources):
+    """
+    Dijkstra on a graph in compressed sparse row format (see ``edge_arrays_to_csr``) with integer edge lengths,
+    seeded with all the ``sources`` (equivalent to a virtual source connected to each of them with length 0).
+
+    :return: ``(distance, predecessor, origin)`` arrays indexed by node: the distance to the nearest source
+             (``UNREACHABLE`` if unreachable), the predecessor on the shortest path (-1 for sources and unreachable
+             nodes) and the position in ``sources`` of the nearest source (-1 if unreachable)
+    """
+    n = len(indptr) - 1
+    distance = np.full(n, UNREACHABLE, dtype=np.int64)
+    predecessor = np.full(n, -1, dtype=np.int64)
+    origin = np.full(n, -1, dtype=np.int64)
+    settled = np.zeros(n, dtype=np.bool_)
+
+    heap = [(0, sources[0], -1, 0)]
+    distance[sources[0]] = 0
+    for i in range(1, len(sources)):
+        if distance[sources[i]] > 0:
+            distance[sources[i]] = 0
+            heapq.heappush(heap, (0, sources[i], -1, i))
+
+    while len(heap) > 0:
+        node_distance, node, parent, source = heapq.heappop(heap)
+        if settled[node]:
+            continue  # outdated heap entry
+        settled[node] = True
+        predecessor[node] = parent
+        origin[node] = source
+        for j in range(indptr[node], indptr[node + 1]):
+            neighbour = np.int64(indices[j])
+            neighbour_distance = node_distance + weights[j]
+            if not settled[neighbour] and neighbour_distance < distance[neighbour]:
+                distance[neighbour] = neighbour_distance
+                heapq.heappush(heap, (neighbour_distance, neighbour, node, source))
+    return distance, predecessor, origin
+
+
 def add_loops_to_network(G, mst_non_directed, new_mst_nodes, mst_edges, type_mat, pipe_dn):
     added_a_loop = False
     # Identify all NONE type nodes in the steiner tree
@@ -281,15 +649,13 @@ def add_plant_close_to_anchor(building_anchor, new_mst_nodes, mst_edges, type_ma
     building_coordinates = building_anchor.geometry.values[0].coords
     x1 = building_coordinates[0][0]
     y1 = building_coordinates[0][1]
-    delta = 10E24  # big number
-    for node in copy_of_new_mst_nodes.iterrows():
-        if node[1]['Type'] == 'NONE':
-            x2 = node[1].geometry.coords[0][0]
-            y2 = node[1].geometry.coords[0][1]
-            distance = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-            if 0 < distance < delta:
-                delta = distance
-                node_id = node[1].Name
+    none_nodes = copy_of_new_mst_nodes[copy_of_new_mst_nodes['Type'] == 'NONE']
+    distances = np.hypot(none_nodes.geometry.x.values - x1, none_nodes.geometry.y.values - y1)
+    distances[distances <= 0] = np.inf  # don't connect the plant to the anchor itself
+    if not np.isfinite(distances).any():
+        raise ValueError('There was an error while adding the plant to the network. '
+                         'The network has no node (other than the anchor building) to connect the plant to.')
+    node_id = none_nodes['Name'].values[np.argmin(distances)]
     pd.options.mode.chained_assignment = None  # avoid warning
     # create copy of selected node and add to list of all nodes
     copy_of_new_mst_nodes.geometry = copy_of_new_mst_nodes.translate(xoff=1, yoff=1)
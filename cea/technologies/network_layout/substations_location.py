@@ -11,6 +11,7 @@ import pandas as pd
 from geopandas import GeoDataFrame as gdf
 from shapely.geometry import Point
 from cea.utilities.standardize_coordinates import get_projected_coordinate_system, get_geographic_coordinate_system
+from cea.technologies.network_layout.connectivity_potential import read_shapefile_columns
 from cea.constants import SHAPEFILE_TOLERANCE
 __author__ = "Jimeno A. Fonseca"
 __copyright__ = "Copyright 2017, Architecture and Building Systems - ETH Zurich"
@@ -29,7 +30,7 @@ def calc_building_centroids(input_buildings_shp,
                             type_network="DH",
                             total_demand=False):
     # # get coordinate system and project to WSG 84
-    zone_df = gdf.from_file(input_buildings_shp)
+    zone_df = read_shapefile_columns(input_buildings_shp, ['Name'])
     zone_df = zone_df.loc[zone_df['Name'].isin(list_district_scale_buildings)]
     zone_df = zone_df.reset_index(drop=True)
 
@@ -0,0 +1,262 @@
+"""
+Test cea.technologies.network_layout
+"""
+
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import networkx as nx
+from geopandas import GeoDataFrame
+from pyproj import CRS
+from shapely.geometry import LineString, Point
+
+import cea.inputlocator
+from cea.technologies.network_layout.connectivity_potential import snap_points, snappy_endings
+from cea.technologies.network_layout.main import calc_potential_network, calc_potential_network_cache_key, \
+    copy_shapefile, layout_network, NetworkLayout
+from cea.technologies.network_layout.steiner_spanning_tree import dijkstra_csr, get_steiner_solver
+
+
+class TestSteinerTree(unittest.TestCase):
+    def setUp(self):
+        # a 5x5 grid with unit edge lengths and a few shortcuts, read from a shapefile like the potential network
+        G = nx.grid_2d_graph(5, 5)
+        nx.set_edge_attributes(G, 1.0, 'weight')
+        G[(0, 0)][(0, 1)]['weight'] = 3.0
+        G[(2, 2)][(2, 3)]['weight'] = 0.5
+        self.edges = [(u, v, data['weight']) for u, v, data in G.edges(data=True)]
+        self.terminals = [(0, 0), (4, 4), (0, 4), (4, 0), (2, 2)]
+        self.folder = tempfile.mkdtemp()
+        # don't re-use the solvers (and their shortest paths) of other tests
+        cache = mock.patch.dict("cea.technologies.network_layout.steiner_spanning_tree._steiner_solver_cache")
+        cache.start()
+        self.addCleanup(cache.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def solver(self, edges=()):
+        """Return the ``SteinerSolver`` of the grid (with additional ``edges``) built from a shapefile"""
+        edges = self.edges + list(edges)
+        path_shp = os.path.join(self.folder, "potential_network.shp")
+        GeoDataFrame({"Shape_Leng": [length for u, v, length in edges]},
+                     geometry=[LineString([u, v]) for u, v, length in edges]).to_file(path_shp)
+        return get_steiner_solver(path_shp, "Shape_Leng")
+
+    def test_mehlhorn_is_a_tree_spanning_the_terminals(self):
+        steiner = self.solver().solve(self.terminals, method='mehlhorn')
+        self.assertTrue(nx.is_tree(steiner))
+        self.assertTrue(set(self.terminals).issubset(steiner.nodes()))
+        for node in steiner.nodes():
+            if steiner.degree(node) == 1:
+                self.assertIn(node, self.terminals)
+
+    def test_mehlhorn_within_approximation_bound(self):
+        steiner = self.solver().solve(self.terminals, method='mehlhorn')
+        length = steiner.size(weight='weight')
+        # the optimal tree has a length of 11.5 and mehlhorn is a 2-approximation
+        self.assertLessEqual(length, 2 * 11.5)
+        self.assertGreaterEqual(length, 11.5)
+
+    def test_mehlhorn_disconnected_terminals(self):
+        solver = self.solver([((10, 10), (10, 11), 1.0)])
+        with self.assertRaises(ValueError):
+            solver.solve(self.terminals + [(10, 10)], method='mehlhorn')
+
+    def test_kou_within_approximation_bound(self):
+        steiner = self.solver().solve(self.terminals, method='kou')
+        self.assertTrue(nx.is_tree(steiner))
+        self.assertTrue(set(self.terminals).issubset(steiner.nodes()))
+        self.assertLessEqual(steiner.size(weight='weight'), 2 * 11.5)
+
+    def test_solver_reuses_shortest_paths(self):
+        solver = self.solver()
+        solver.cache_size = 4
+        with mock.patch("cea.technologies.network_layout.steiner_spanning_tree.dijkstra_csr",
+                        wraps=dijkstra_csr) as dijkstra:
+            first = solver.solve(self.terminals[:4], method='kou')
+            self.assertEqual(dijkstra.call_count, 4)
+            # solving again for the same terminals re-uses the shortest paths and doesn't change the result
+            self.assertEqual(set(first.edges()), set(solver.solve(self.terminals[:4], method='kou').edges()))
+            self.assertEqual(dijkstra.call_count, 4)
+            # only the shortest paths of the new terminal are calculated, dropping the least recently used ones
+            solver.solve(self.terminals[1:], method='kou')
+            self.assertEqual(dijkstra.call_count, 5)
+            solver.shortest_paths(self.terminals[1])
+            self.assertEqual(dijkstra.call_count, 5)
+            solver.shortest_paths(self.terminals[0])
+            self.assertEqual(dijkstra.call_count, 6)
+
+    def test_exact_is_optimal(self):
+        solver = self.solver()
+        steiner = solver.solve(self.terminals, method='exact')
+        self.assertTrue(nx.is_tree(steiner))
+        self.assertTrue(set(self.terminals).issubset(steiner.nodes()))
+        self.assertAlmostEqual(steiner.size(weight='weight'), 11.5)
+        self.assertLessEqual(steiner.size(weight='weight'),
+                             solver.solve(self.terminals, method='mehlhorn').size(weight='weight'))
+
+    def test_solver_invalid_method(self):
+        with self.assertRaises(ValueError):
+            self.solver().solve(self.terminals, method='dijkstra')
+
+
+class TestGetSteinerSolver(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path_shp = os.path.join(self.folder, "potential_network.shp")
+        GeoDataFrame({"Shape_Leng": [1.0, 2.0]},
+                     geometry=[LineString([(0, 0), (1, 0)]), LineString([(1, 0), (1, 2)])]).to_file(self.path_shp)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_copies_share_the_solver(self):
+        path_copy_shp = os.path.join(self.folder, "potential_network_copy.shp")
+        copy_shapefile(self.path_shp, path_copy_shp)
+        solver = get_steiner_solver(self.path_shp, "Shape_Leng")
+        self.assertIs(solver, get_steiner_solver(path_copy_shp, "Shape_Leng"))
+        self.assertEqual(solver.G.size(weight="weight"), 3.0)
+
+    def test_changed_shapefile_is_read_again(self):
+        solver = get_steiner_solver(self.path_shp, "Shape_Leng")
+        GeoDataFrame({"Shape_Leng": [1.0]}, geometry=[LineString([(0, 0), (1, 0)])]).to_file(self.path_shp)
+        self.assertIsNot(solver, get_steiner_solver(self.path_shp, "Shape_Leng"))
+
+
+class TestSnappyEndings(unittest.TestCase):
+    def test_snap_to_closest_vertex(self):
+        lines = [LineString([(0.0, 0.0), (10.0, 0.0)]), LineString([(10.5, 0.0), (20.0, 0.0)])]
+        snapped = snappy_endings(lines, 1.0, None)
+        self.assertEqual([list(line.coords) for line in snapped.geometry],
+                         [[(0.0, 0.0), (10.5, 0.0)], [(10.5, 0.0), (20.0, 0.0)]])
+
+    def test_snap_to_vertex_moved_onto_a_snapped_location(self):
+        # (1.4, 1.8) is snapped to (0.2, 1.3), which is then snapped to (0.5, 0.1): a vertex is still left at
+        # (0.2, 1.3), so (0.5, 0.1) can snap to it
+        lines = [LineString([(1.4, 1.8), (0.2, 1.3)]), LineString([(4.4, 2.6), (0.5, 0.1)])]
+        snapped = snappy_endings(lines, 1.5, None)
+        self.assertEqual([list(line.coords) for line in snapped.geometry], [[(4.4, 2.6), (0.2, 1.3)]])
+
+    def test_no_vertex_within_max_distance(self):
+        lines = [LineString([(0.0, 0.0), (10.0, 0.0)]), LineString([(15.0, 0.0), (20.0, 0.0)])]
+        snapped = snappy_endings(lines, 1.0, None)
+        self.assertEqual([list(line.coords) for line in snapped.geometry], [list(line.coords) for line in lines])
+
+
+class TestSnapPoints(unittest.TestCase):
+    def test_point_close_to_a_snapped_point(self):
+        # (5.5, 2.2) is too far from the original line, but close enough to it once (5, 1) is snapped
+        points = GeoDataFrame(geometry=[Point(5.0, 1.0), Point(5.5, 2.2)])
+        lines = GeoDataFrame(geometry=[LineString([(0.0, 0.0), (10.0, 0.0)])])
+        _, snapped = snap_points(points, lines, 1.5, None)
+        line = snapped.geometry.iloc[0]
+        self.assertIn((5.0, 1.0), line.coords)
+        self.assertIn((5.5, 2.2), line.coords)
+
+
+class TestPotentialNetworkCache(unittest.TestCase):
+    def setUp(self):
+        self.scenario = tempfile.mkdtemp()
+        self.locator = cea.inputlocator.InputLocator(scenario=self.scenario)
+        for path in (self.locator.get_zone_geometry(), self.locator.get_street_network()):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(os.path.basename(path))
+        self.crs = CRS("+proj=utm +zone=32 +ellps=WGS84 +datum=WGS84 +units=m +no_defs")
+        self.temporary_folder = tempfile.mkdtemp()
+        self.locator.get_temporary_folder = lambda: self.temporary_folder
+
+    def tearDown(self):
+        shutil.rmtree(self.scenario, ignore_errors=True)
+        shutil.rmtree(self.temporary_folder, ignore_errors=True)
+
+    def cache_entries(self):
+        return sorted(entry for entry in os.listdir(self.temporary_folder) if entry.startswith("netcache_"))
+
+    def cache_key(self, buildings=("B001", "B002")):
+        return calc_potential_network_cache_key(self.locator.get_zone_geometry(), self.locator.get_street_network(),
+                                                list(buildings), False, "DC", self.locator.get_total_demand())
+
+    def test_cache_key(self):
+        self.assertEqual(self.cache_key(), self.cache_key(buildings=("B002", "B001")))
+        self.assertNotEqual(self.cache_key(), self.cache_key(buildings=("B001",)))
+
+        key = self.cache_key()
+        with mock.patch("cea.__version__", "0.0.0"):
+            self.assertNotEqual(key, self.cache_key())
+        with mock.patch("cea.technologies.network_layout.main.POTENTIAL_NETWORK_CACHE_VERSION", 0):
+            self.assertNotEqual(key, self.cache_key())
+
+        with open(self.locator.get_street_network(), "a") as f:
+            f.write("changed")
+        self.assertNotEqual(key, self.cache_key())
+
+    def calc_potential_network(self):
+        """Call ``calc_potential_network`` with the expensive calculations replaced by writing dummy shapefiles"""
+        def calc_building_centroids(path_zone_shp, temp_path_building_centroids_shp, *args):
+            with open(temp_path_building_centroids_shp, "w") as f:
+                f.write("centroids")
+
+        def calc_connectivity_network(path_streets_shp, building_centroids_df, temp_path_potential_network_shp):
+            with open(temp_path_potential_network_shp, "w") as f:
+                f.write("potential network")
+            return self.crs
+
+        network_layout = NetworkLayout()
+        network_layout.connected_buildings = ["B001", "B002"]
+        temp_path_potential_network_shp = self.locator.get_temporary_file("potential_network_test_cache.shp")
+        temp_path_building_centroids_shp = self.locator.get_temporary_file("nodes_buildings_test_cache.shp")
+        with mock.patch("cea.technologies.network_layout.substations_location.calc_building_centroids",
+                        side_effect=calc_building_centroids) as centroids, \
+                mock.patch("cea.technologies.network_layout.connectivity_potential.calc_connectivity_network",
+                           side_effect=calc_connectivity_network) as connectivity:
+            crs = calc_potential_network(network_layout, self.locator, temp_path_building_centroids_shp,
+                                         temp_path_potential_network_shp)
+        with open(temp_path_potential_network_shp) as f:
+            self.assertEqual(f.read(), "potential network")
+        os.remove(temp_path_potential_network_shp)
+        os.remove(temp_path_building_centroids_shp)
+        return crs, centroids.called or connectivity.called
+
+    def test_layout_network_uses_the_network_name(self):
+        with mock.patch("cea.technologies.network_layout.main.calc_potential_network", return_value=self.crs), \
+                mock.patch("cea.technologies.network_layout.steiner_spanning_tree.calc_steiner_spanning_tree") \
+                as calc_steiner_spanning_tree:
+            layout_network(NetworkLayout(), self.locator, ["B001"], output_name_network="opt_1")
+        args = calc_steiner_spanning_tree.call_args[0]
+        self.assertEqual(args[1], self.locator.get_temporary_file("potential_network.shp"))
+        self.assertEqual(args[2], self.locator.get_input_network_folder("DC", "opt_1"))
+        self.assertEqual(args[4], self.locator.get_network_layout_edges_shapefile("DC", "opt_1"))
+        self.assertEqual(args[16], "mehlhorn")
+
+    def test_cache_miss_then_hit(self):
+        crs, calculated = self.calc_potential_network()
+        self.assertTrue(calculated)
+        self.assertEqual(crs, self.crs)
+
+        crs, calculated = self.calc_potential_network()
+        self.assertFalse(calculated)
+        self.assertEqual(crs, self.crs)
+        self.assertEqual(self.cache_entries(), ["netcache_" + self.cache_key()])
+
+    def test_cache_keeps_most_recently_used_entries(self):
+        self.calc_potential_network()
+        first_key = self.cache_key()
+        with mock.patch("cea.technologies.network_layout.main.POTENTIAL_NETWORK_CACHE_SIZE", 1):
+            with open(self.locator.get_zone_geometry(), "a") as f:
+                f.write("changed")
+            crs, calculated = self.calc_potential_network()
+        self.assertTrue(calculated)
+        self.assertNotEqual(first_key, self.cache_key())
+        self.assertEqual(self.cache_entries(), ["netcache_" + self.cache_key()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -54,13 +54,17 @@ def consume_nowait(q, msg):
 
 
 def stream_poster(jobid, server, queue):
-    """Post items from queue until a sentinel (the EOFError class object) is read."""
-    msg = queue.get(block=True, timeout=None)  # block until first message
+    """
+    Post items from queue until a sentinel (the EOFError class object) is read. All posts go through the same
+    session, so the connection to the server is kept alive instead of being re-opened for every message.
+    """
+    with requests.Session() as session:
+        msg = queue.get(block=True, timeout=None)  # block until first message
 
-    while not msg is EOFError:
-        msg = consume_nowait(queue, msg)
-        requests.put("{server}/streams/write/{jobid}".format(**locals()), data=msg)
-        msg = queue.get(block=True, timeout=None)  # block until next message
+        while not msg is EOFError:
+            msg = consume_nowait(queue, msg)
+            session.put("{server}/streams/write/{jobid}".format(**locals()), data=msg)
+            msg = queue.get(block=True, timeout=None)  # block until next message
 
 
 class JobServerStream(object):